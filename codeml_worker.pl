@@ -10,6 +10,7 @@
 
 use strict;
 use warnings;
+use Time::HiRes qw(time);
 
 my $bin = 'codeml';                     # CODEML binary
 my $pwd = $ENV{PWD};                    # current path
@@ -21,6 +22,13 @@ my @temp_files = qw/rub rst rst1 4fold.nuc lnf 2NG.t 2NG.dS 2NG.dN/;
 my $failed = 0;
 my $H0_RESULT_FILE_SFX = '.H0.mlc';
 my $H1_RESULT_FILE_SFX = '.H1.mlc';
+my $TELEMETRY_FILE_SFX = '.telemetry.tsv'; # per-run resource usage
+my @TELEMETRY_FIELDS = qw/ctl host cpu start_time end_time wall_time user_time sys_time max_rss_kb exit_code/;
+my $GNU_TIME = '/usr/bin/time';         # used to measure max RSS (if available)
+my $WARM_CTL_SFX = '.warm.ctl';         # control file warm-started from the previous run
+my $WARM_TREE_SFX = '.warm.nwk';        # tree file with the previous run's branch lengths
+my $warm_start = 0;                     # option -w
+my $prev_outfile;                       # output file of the previous run
 my $CODEML;
 
 # Check if the run-time environment (RTE) is set
@@ -40,7 +48,13 @@ if ($RTE) {
 
 # Run CODEML sequentially for all control files specified on the command line.
 # This could be used e.g., for testing the null (H0) and alternative (H1) hypotheses.
-die "Usage: $0 [CONTROL FILE 1]...\n" if @ARGV == 0;
+# With the -w option each run but the first is warm-started from the MLEs
+# (branch lengths, kappa and omega) of the previous run, e.g. H1 from H0.
+if (@ARGV && $ARGV[0] eq '-w') {
+    $warm_start = 1;
+    shift @ARGV;
+}
+die "Usage: $0 [-w] [CONTROL FILE 1]...\n" if @ARGV == 0;
 
 foreach my $ctl(@ARGV) {
     my $stime = GetTime();
@@ -48,6 +62,9 @@ foreach my $ctl(@ARGV) {
     my $outfile;
     my %codeml_infiles;
     my $exit_code = 0;
+    my %usage = (ctl => $ctl, host => $host, cpu => $cpuinfo, start_time => $stime);
+    my $t0 = time();
+    my ($cuser0, $csys0) = (times)[2, 3];
 
     # Print some header info into stdout
     print "COMMAND: $CODEML $ctl\n";
@@ -63,7 +80,7 @@ foreach my $ctl(@ARGV) {
     open CTL, $ctl or die "ERROR: Cannot open file '$ctl'.\n"; # exit with 2 if no file
     while (<CTL>) {
         if (/(seqfile|treefile)\s*=\s*(\S+)/i) {
-            my $name = $1;
+            my $name = lc $1; # e.g. 'TreeFile'
             my $path = $2;
             $codeml_infiles{$name} = $path;
 	} elsif (/outfile\s*=\s*(\S+)/i) {
@@ -83,10 +100,37 @@ foreach my $ctl(@ARGV) {
         }
     }      
     print "OUTFILE: $outfile\n";
-    exit $exit_code if $exit_code; # don't continue if no input file(s)
-    
-    # Try to run CODEML
-    system($CODEML, $ctl);
+
+    # Write the control file actually used for this run (warm-started if possible)
+    my $run_ctl = $ctl;
+    if ($warm_start && defined $prev_outfile && !$exit_code) {
+        $run_ctl = WarmStart($ctl, $codeml_infiles{treefile}, $prev_outfile);
+        print "WARM_START: $run_ctl\n";
+    }
+    $prev_outfile = $outfile;
+
+    if ($exit_code) { # don't continue if no input file(s)
+        @usage{qw/end_time wall_time exit_code/} = (GetTime(), 0, $exit_code);
+        WriteTelemetry($ctl, \%usage);
+        exit $exit_code;
+    }
+
+    # Try to run CODEML (wrapped by GNU time to get the peak memory usage)
+    my $rss_file = "$ctl.rss";
+    unlink $rss_file;
+    if (-x $GNU_TIME) {
+        system($GNU_TIME, '-f', '%M', '-o', $rss_file, $CODEML, $run_ctl);
+        $? = -1 if ($? >> 8) == 127 && ! -x $CODEML; # GNU time could not run codeml
+    } else {
+        system($CODEML, $run_ctl);
+    }
+    my $status = $?;
+    my ($cuser1, $csys1) = (times)[2, 3];
+    $usage{wall_time} = sprintf("%.2f", time() - $t0);
+    $usage{user_time} = sprintf("%.2f", $cuser1 - $cuser0);
+    $usage{sys_time} = sprintf("%.2f", $csys1 - $csys0);
+    $usage{max_rss_kb} = GetMaxRSS($rss_file);
+    $? = $status;
 
     if ($? == -1) {
         # failed to execute CODEML so exit with code 127
@@ -95,7 +139,7 @@ foreach my $ctl(@ARGV) {
         print STDERR "Error: Command '$CODEML' not found (exit code: $exit_code).\n";
     } elsif ($? != 0) {
         $exit_code = 1;
-        print STDERR "Error: Failed to run '$CODEML' on file '$ctl' (exit code: $exit_code).\n";
+        print STDERR "Error: Failed to run '$CODEML' on file '$run_ctl' (exit code: $exit_code).\n";
     } elsif (! -e $outfile) {
         $exit_code = 4;
         print STDERR "Error: Output file '$outfile' not found (exit code: $exit_code).\n";
@@ -107,6 +151,8 @@ foreach my $ctl(@ARGV) {
     $etime = GetTime();
     print "EXIT_CODE: $exit_code\n";
     print "END_TIME: $etime\n";
+    @usage{qw/end_time exit_code/} = ($etime, $exit_code);
+    WriteTelemetry($ctl, \%usage);
     exit $exit_code if $exit_code;
 }
 
@@ -131,6 +177,226 @@ sub GetTime {
     return $time;
 }
 
+# Get the peak memory usage (kB) of codeml as reported by GNU time
+sub GetMaxRSS {
+    my $file = shift;
+    my $rss;
+
+    return undef unless -e $file;
+    open RSS, $file or return undef;
+    while (<RSS>) {
+        $rss = $1 if /^\s*(\d+)\s*$/; # last line holds the value
+    }
+    close RSS;
+    unlink $file;
+    return $rss;
+}
+
+# Write resource usage of a codeml run into a tab-separated file
+# (header + one record) named after the control file, e.g.
+# FAM_1.1.H0.ctl -> FAM_1.1.H0.telemetry.tsv
+sub WriteTelemetry {
+    my ($ctl, $usage) = @_;
+    (my $file = $ctl) =~ s/\.ctl$//i;
+    $file .= $TELEMETRY_FILE_SFX;
+
+    my @values = map {
+        my $val = defined $usage->{$_} ? $usage->{$_} : 'NA';
+        $val =~ s/\s+/ /g; # no tabs/newlines inside fields
+        $val =~ s/^ | $//g;
+        $val
+    } @TELEMETRY_FIELDS;
+
+    open TSV, ">$file" or die "Error: Cannot write telemetry file '$file'.\n";
+    print TSV join("\t", @TELEMETRY_FIELDS), "\n";
+    print TSV join("\t", @values), "\n";
+    close TSV;
+}
+
+# Parse codeml output file (*.mlc) for the MLEs used to warm-start the next run,
+# i.e. the tree labelled with taxon names and estimated branch lengths
+# (the second tree after 'tree length'), kappa and omega (if estimated)
+sub ParseMLEs {
+    my $file = shift;
+    my %mle;
+    my $n_trees = -1; # no 'tree length' line yet
+
+    open MLC, $file or return \%mle;
+    while (<MLC>) {
+        if (/^tree\s+length\s*=/i) {
+            $n_trees = 0;
+        } elsif ($n_trees >= 0 && /^\s*\(.*\)\s*;\s*$/) {
+            $n_trees++;
+            if ($n_trees == 2) {
+                chomp($mle{tree} = $_);
+                $n_trees = -1;
+            }
+        } elsif (/kappa\s+\(ts\/tv\)\s*=\s*([-+\d.eE]+)/i) {
+            $mle{kappa} = $1;
+        } elsif (/omega\s+\(dN\/dS\)\s*=\s*([-+\d.eE]+)/i) {
+            $mle{omega} = $1;
+        }
+    }
+    close MLC;
+    return \%mle;
+}
+
+# Parse a Newick tree into nested nodes: { name, mark (#n), blen, children, taxa }
+sub ParseNewick {
+    my $str = shift;
+    my @stack = ({ children => [] });
+    my $last; # node closed/read last
+
+    while ($str =~ /\G\s*(\(|\)|,|;|[#\$]\d+|:\s*[-+\d.eE]+|[^\s(),:;#\$]+)/gc) {
+        my $tok = $1;
+        if ($tok eq '(') {
+            my $node = { children => [] };
+            push @{$stack[-1]{children}}, $node;
+            push @stack, $node;
+            $last = undef;
+        } elsif ($tok eq ')') {
+            return undef if @stack < 2;
+            $last = pop @stack;
+        } elsif ($tok eq ',' || $tok eq ';') {
+            $last = undef;
+        } elsif ($tok =~ /^\$/) {
+            return undef; # clade labels are not supported
+        } elsif ($tok =~ /^#/) {
+            $last->{mark} = $tok if $last;
+        } elsif ($tok =~ /^:\s*(\S+)/) {
+            $last->{blen} = $1 if $last;
+        } elsif (!$last) { # taxon name; labels of internal nodes are ignored
+            $last = { name => $tok, children => [] };
+            push @{$stack[-1]{children}}, $last;
+        }
+    }
+    return undef unless @stack == 1 && @{$stack[0]{children}} == 1;
+    my $root = $stack[0]{children}[0];
+    SetTaxa($root);
+    return $root;
+}
+
+# Set the sorted list of taxa below each node
+sub SetTaxa {
+    my $node = shift;
+    my @taxa = defined $node->{name} ? ($node->{name}) : ();
+    push @taxa, @{ SetTaxa($_) } for @{$node->{children}};
+    $node->{taxa} = [ sort @taxa ];
+    return $node->{taxa};
+}
+
+# Return all nodes of the tree except the root (i.e. the branches)
+sub GetBranches {
+    my $node = shift;
+    return map { ($_, GetBranches($_)) } @{$node->{children}};
+}
+
+sub WriteNewick {
+    my $node = shift;
+    my $str = @{$node->{children}}
+        ? '(' . join(',', map { WriteNewick($_) } @{$node->{children}}) . ')'
+        : $node->{name};
+    $str .= $node->{mark} if defined $node->{mark};
+    $str .= ':' . $node->{blen} if defined $node->{blen};
+    return $str;
+}
+
+# Return the tree estimated by codeml with the branch marks (#n) of the input
+# tree. Marks are matched by their clade; if the codeml tree is unrooted
+# (clock = 0), also by the split of taxa they define, so that they are kept
+# when codeml unroots the input tree. Return undef if a mark cannot be placed.
+sub MarkTree {
+    my ($in_str, $mlc_str) = @_;
+    my $in = ParseNewick($in_str);
+    my $mlc = ParseNewick($mlc_str);
+    return undef unless $in && $mlc;
+
+    my @all = @{$in->{taxa}};
+    return undef unless join(',', @all) eq join(',', @{$mlc->{taxa}});
+
+    # in a rooted tree both branches at the root define the same split
+    my $unrooted = @{$mlc->{children}} >= 3;
+    my (%clades, %splits); # taxa below/on the other side -> branch of the codeml tree
+    for my $node (GetBranches($mlc)) {
+        delete $node->{mark};
+        my %in_clade = map { $_ => 1 } @{$node->{taxa}};
+        my @rest = grep { !$in_clade{$_} } @all;
+        $clades{join(',', @{$node->{taxa}})} = $node;
+        $splits{join(',', @rest)} = $node if $unrooted;
+    }
+
+    for my $node (grep { defined $_->{mark} } GetBranches($in)) {
+        my $key = join(',', @{$node->{taxa}});
+        my $branch = $clades{$key} || $splits{$key};
+        return undef unless $branch;
+        $branch->{mark} = $node->{mark};
+    }
+    return WriteNewick($mlc) . ';';
+}
+
+# Write a control file (*.warm.ctl) and a tree file (*.warm.nwk) that start
+# codeml from the MLEs of the previous run (branch lengths are taken as initial
+# values with fix_blength = 1). The original files are copied unchanged if the
+# previous run cannot be used or branch lengths are fixed (fix_blength = 2) or
+# random (fix_blength = -1), so that the control file of every run is recorded.
+sub WarmStart {
+    my ($ctl, $treefile, $mlc) = @_;
+    (my $base = $ctl) =~ s/\.ctl$//i;
+    my $warm_ctl = $base . $WARM_CTL_SFX;
+    my $warm_tree = $base . $WARM_TREE_SFX;
+    my $mle = (-e $mlc && IsValid($mlc)) ? ParseMLEs($mlc) : {};
+    my (@tree, @ctl, %fixed);
+
+    open CTL, $ctl or die "ERROR: Cannot open file '$ctl'.\n";
+    @ctl = <CTL>;
+    close CTL;
+    for (@ctl) {
+        $fixed{lc $1} = $2 if /^\s*(fix_kappa|fix_omega|fix_blength)\s*=\s*(-?\d+)/i;
+    }
+
+    if (defined $treefile && open TREE, $treefile) {
+        @tree = <TREE>;
+        close TREE;
+    }
+
+    # replace the (first) tree by the one estimated in the previous run
+    my $warm = 0;
+    my ($tree_idx) = grep { $tree[$_] =~ /\(/ } 0..$#tree;
+    my $fix_blength = defined $fixed{fix_blength} ? $fixed{fix_blength} : 0;
+    if (!@tree) { # e.g. runmode = -2
+        print STDERR "Warning: Cannot warm-start '$ctl' without a tree file; using initial values.\n";
+    } elsif ($fix_blength != 0 && $fix_blength != 1) {
+        print STDERR "Warning: Cannot warm-start '$ctl' with fix_blength = $fix_blength; using initial values.\n";
+    } elsif (defined $tree_idx && defined $mle->{tree}
+             && defined(my $str = MarkTree($tree[$tree_idx], $mle->{tree}))) {
+        $tree[$tree_idx] = "$str\n";
+        $warm = 1;
+    } else {
+        print STDERR "Warning: Cannot warm-start '$ctl' from '$mlc'; using initial values.\n";
+    }
+
+    my $has_fix_blength = 0;
+    for (@ctl) {
+        s/^(\s*treefile\s*=\s*)\S+/$1$warm_tree/i if @tree;
+        next unless $warm; # keep the original initial values
+        $has_fix_blength = 1 if s/^(\s*fix_blength\s*=\s*)\S+/${1}1/i;
+        s/^(\s*kappa\s*=\s*)\S+/$1$mle->{kappa}/i if defined $mle->{kappa} && !$fixed{fix_kappa};
+        s/^(\s*omega\s*=\s*)\S+/$1$mle->{omega}/i if defined $mle->{omega} && !$fixed{fix_omega};
+    }
+    push @ctl, "fix_blength = 1\n" if $warm && !$has_fix_blength;
+
+    if (@tree) {
+        open TREE, ">$warm_tree" or die "Error: Cannot write tree file '$warm_tree'.\n";
+        print TREE @tree;
+        close TREE;
+    }
+
+    open CTL, ">$warm_ctl" or die "Error: Cannot write control file '$warm_ctl'.\n";
+    print CTL @ctl;
+    close CTL;
+    return $warm_ctl;
+}
+
 # Post-processing of the output file (*.mlc)
 sub IsValid {
     my $file = shift;
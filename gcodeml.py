@@ -7,6 +7,11 @@
 
 import os
 import re
+import hashlib
+import multiprocessing
+import shutil
+import socket
+import sqlite3
 import subprocess, shlex
 import time
 
@@ -26,6 +31,7 @@ class xrsl:
       self.__walltime = None
       self.__runtimeenvironment = 'APPS/BIO/CODEML-4.4.3'
       self.__cluster = None
+      self.__excluded = []
       self.__jobname = None
       #self.__nodeaccess = '"inbound"|"outbound"' - request clusters with in/out IP connectivity
 
@@ -68,6 +74,9 @@ class xrsl:
    def getCluster(self):
       return self.__cluster
 
+   def getExcluded(self):
+      return self.__excluded
+
    def getXrsl(self):
       """Return xRSL job description string.
       """
@@ -102,6 +111,9 @@ class xrsl:
       if xrsl.getCluster(self):
          _xrsl_str += '(cluster="%s")\n' % xrsl.getCluster(self)
 
+      for cluster in xrsl.getExcluded(self):
+         _xrsl_str += '(cluster!="%s")\n' % cluster
+
       return _xrsl_str
 
    def __repr__(self):
@@ -151,8 +163,13 @@ class xrsl:
       # TODO: Exception handling, hostname format, lookup table
       self.__cluster = cluster
 
+   def setExcluded(self, clusters):
+      self.__excluded = clusters
+
 class job(xrsl):
    __states = ['NEW', 'SUBMITTED', 'RUNNING', 'TERMINATED']
+   __warmopt = '-w'            # codeml_worker.pl option to warm-start runs
+   __warmsfx = ['.warm.ctl', '.warm.nwk'] # files written by warm-started runs
 
    def __init__(self, jobname, args, inputfiles, outputfiles):
       self.__stateidx = 0
@@ -160,8 +177,8 @@ class job(xrsl):
       self.__returncode = None     # "fake" ngsub exitcode
       self.__cluster = None        # cluster on which the job ran
       self.__status = None         # as reported by ngstat [not implemented]
-      self.__timesubmitted = None  # as reported by ngstat [not implemented]
-      self.__timecompleted = None  # as reported by ngstat [not implemented]
+      self.__timesubmitted = None  # client-side submission (float) time
+      self.__timecompleted = None  # client-side completion (float) time
       self.__executionnode = None  # as reported by ngstat [not implemented]
       self.__alninfo = []          # alignment length &
                                    # number of sequences
@@ -191,6 +208,12 @@ class job(xrsl):
    def _getCluster(self):
       return self.__cluster
 
+   def getTsubmitted(self):
+      return self.__timesubmitted
+
+   def getTcompleted(self):
+      return self.__timecompleted
+
    def getAlninfo(self):
       return self.__alninfo
 
@@ -203,6 +226,9 @@ class job(xrsl):
    #def getAlnfile(self):
    #    return job.getAlninfo(self)[0]['path']
 
+   def getWarmstart(self):
+      return job.__warmopt in job.getArgs(self)
+
    def getInfiles(self, file_sfx):
       return [ f for f in job.getInputs(self) if f.endswith(file_sfx) ]
 
@@ -235,6 +261,11 @@ class job(xrsl):
       else:
          pass
 
+   def setState(self, state):
+      if state not in job.__states:
+         raise RuntimeError("Unknown job state '%s'." % state)
+      self.__stateidx = job.__states.index(state)
+
    def setId(self, jobid):
       self.__gridjobid = jobid
 
@@ -244,8 +275,244 @@ class job(xrsl):
    def _setCluster(self, cls):
       self.__cluster = cls
 
+   def setTsubmitted(self, tm):
+      self.__timesubmitted = tm
+
+   def setTcompleted(self, tm):
+      self.__timecompleted = tm
+
+   def setWarmstart(self, warm=True):
+      """Warm-start each codeml run (e.g. H1) from the MLEs of the preceding
+      run (e.g. H0). The control and tree files of the warm-started runs
+      are added to the job outputs so that these runs can be reproduced.
+      """
+      _ctl_files = [ a for a in job.getArgs(self) if a != job.__warmopt ]
+      _warm_files = []
+      for ctl in _ctl_files[1:]:
+         base = re.sub('\.ctl$', '', ctl)
+         _warm_files.extend([ base + sfx for sfx in job.__warmsfx ])
+      _outputs = [ f for f in job.getOutputs(self) if f not in _warm_files ]
+
+      if warm:
+         xrsl.setArgs(self, [job.__warmopt] + _ctl_files)
+         xrsl.setOutputs(self, _outputs + _warm_files)
+      else:
+         xrsl.setArgs(self, _ctl_files)
+         xrsl.setOutputs(self, _outputs)
+
+def _isValidMlc(path):
+   """Return True if the codeml output file is complete ('Time used' is present)."""
+   _TIME_USED_RE = re.compile('Time\s+used:\s*\S+', re.I)
+   if not os.path.isfile(path):
+      return False
+   f = open(path, 'r')
+   try:
+      for line in f:
+         if _TIME_USED_RE.search(line):
+            return True
+   finally:
+      f.close()
+   return False
+
+class resultcache:
+   """Cache of validated codeml outputs (*.mlc) keyed by a hash of the job's
+   input files, arguments, codeml RTE and worker script. The least recently
+   used entries are evicted when the cache grows beyond maxsize (bytes).
+   """
+   __resultsfx = '.mlc'
+
+   def __init__(self, cachedir, maxsize=1024 ** 3):
+      self.__cachedir = cachedir
+      self.__maxsize = maxsize
+      self.__digests = {} # path -> digest of the worker script
+      if not os.path.isdir(cachedir):
+         os.makedirs(cachedir)
+
+   #
+   # Accessor methods: "getters"
+   #
+   def getCachedir(self):
+      return self.__cachedir
+
+   def getMaxsize(self):
+      return self.__maxsize
+
+   def getSize(self):
+      return sum(size for size, mtime, path in resultcache._entries(self))
+
+   @staticmethod
+   def _hashFile(sha, path):
+      f = open(path, 'rb')
+      try:
+         while True:
+            block = f.read(1 << 20)
+            if not block: break
+            sha.update(block)
+      finally:
+         f.close()
+
+   def getKey(self, job):
+      """Return the cache key of the job or None if an input file is missing."""
+      sha = hashlib.sha1()
+      sha.update('rte=%s\n' % job.getRtenv())
+      sha.update('args=%s\n' % ' '.join(job.getArgs()))
+
+      worker = job.getExec()
+      if worker not in self.__digests:
+         wsha = hashlib.sha1(worker)
+         if os.path.isfile(worker):
+            resultcache._hashFile(wsha, worker)
+         self.__digests[worker] = wsha.hexdigest()
+      sha.update('exec=%s\n' % self.__digests[worker])
+
+      for path in sorted(job.getInputs(), key=os.path.basename):
+         sha.update('input=%s\n' % os.path.basename(path))
+         try:
+            resultcache._hashFile(sha, path)
+         except (IOError, OSError): # no key, i.e. a cache miss
+            return None
+      return sha.hexdigest()
+
+   def getResults(self, job):
+      return [ f for f in job.getOutputs() if f.endswith(resultcache.__resultsfx) ]
+
+   def lookup(self, job, destdir):
+      """Copy the cached results of the job into destdir.
+      Return True on a cache hit.
+      """
+      key = resultcache.getKey(self, job)
+      results = [ os.path.basename(f) for f in resultcache.getResults(self, job) ]
+      if not key or not results:
+         return False
+      entry = os.path.join(self.__cachedir, key)
+      if not os.path.isdir(entry):
+         return False
+      for f in results:
+         if not _isValidMlc(os.path.join(entry, f)):
+            return False
+
+      if not os.path.isdir(destdir):
+         os.makedirs(destdir)
+      for f in results:
+         shutil.copy2(os.path.join(entry, f), os.path.join(destdir, f))
+      os.utime(entry, None) # mark as recently used
+      return True
+
+   def store(self, job, srcdir):
+      """Store the job results found in srcdir if all of them are valid.
+      Return the cache entry or None if the results have not been cached.
+      The cache is not evicted here; call evict() after storing results.
+      """
+      key = resultcache.getKey(self, job)
+      results = [ os.path.basename(f) for f in resultcache.getResults(self, job) ]
+      if not key or not results:
+         return None
+      entry = os.path.join(self.__cachedir, key)
+      if os.path.isdir(entry):
+         return None
+      for f in results:
+         if not _isValidMlc(os.path.join(srcdir, f)):
+            return None
+
+      # copy into a temporary directory first so that entries are complete
+      tmp = os.path.join(self.__cachedir, '.%s.%d' % (key, os.getpid()))
+      os.mkdir(tmp)
+      for f in results:
+         shutil.copy2(os.path.join(srcdir, f), os.path.join(tmp, f))
+      try:
+         os.rename(tmp, entry)
+      except OSError: # stored by another process in the meantime
+         shutil.rmtree(tmp, True)
+         return None
+      return entry
+
+   def _entries(self):
+      """Return (size, last use, path) of all cache entries."""
+      entries = []
+      for key in os.listdir(self.__cachedir):
+         if key.startswith('.'): continue # incomplete entry
+         path = os.path.join(self.__cachedir, key)
+         if not os.path.isdir(path): continue
+         size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+         entries.append((size, os.path.getmtime(path), path))
+      return entries
+
+   def evict(self):
+      """Remove the least recently used entries until the cache fits in maxsize.
+      Return the removed entries.
+      """
+      entries = sorted(resultcache._entries(self), key=lambda e: e[1])
+      total = sum(e[0] for e in entries)
+      removed = []
+      for size, mtime, path in entries:
+         if total <= self.__maxsize: break
+         shutil.rmtree(path, True)
+         removed.append(path)
+         total -= size
+      return removed
+
+def _checkJob(task):
+   """Check the codeml control files of a job before it is submitted,
+   i.e. that the seqfile/treefile/outfile names match the job inputs and
+   outputs and that the alignment and tree have the same number of taxa.
+   Return the job name and a list of errors (empty if the job is valid).
+   """
+   jobname, inputs, outputs = task
+   _CTL_RE = re.compile('(?P<name>seqfile|treefile|outfile)\s*=\s*(?P<path>\S+)', re.I)
+   _TAXON_RE = re.compile('[(,]\s*(?P<taxon>[^\s(),:;#]+)')
+   infiles = dict((os.path.basename(f), f) for f in inputs)
+   outfiles = [ os.path.basename(f) for f in outputs ]
+   errors = []
+
+   for ctl in [ f for f in inputs if f.endswith('.ctl') ]:
+      if not os.path.exists(ctl):
+         errors.append("No control file '%s' found." % ctl)
+         continue
+      names = {}
+      f = open(ctl, 'r')
+      for line in f:
+         match = _CTL_RE.search(line)
+         if match:
+            names[match.group('name').lower()] = match.group('path')
+      f.close()
+
+      for name in ('seqfile', 'treefile', 'outfile'):
+         if name not in names:
+            errors.append("%s: '%s' is not set." % (ctl, name))
+      for name in ('seqfile', 'treefile'):
+         if name in names and names[name] not in infiles:
+            errors.append("%s: %s '%s' is not a job input." % (ctl, name, names[name]))
+      if 'outfile' in names and names['outfile'] not in outfiles:
+         errors.append("%s: outfile '%s' is not a job output." % (ctl, names['outfile']))
+      if 'seqfile' not in names or 'treefile' not in names: continue
+
+      seqfile = infiles.get(names['seqfile'])
+      treefile = infiles.get(names['treefile'])
+      if not seqfile or not treefile: continue
+      missing = [ path for path in (seqfile, treefile) if not os.path.exists(path) ]
+      for path in missing:
+         errors.append("%s: '%s' not found." % (ctl, path))
+      if missing: continue
+
+      try:
+         n_seq = int(job._parseAlignment(seqfile)['n_seq'])
+      except Exception:
+         errors.append("%s: no PHYLIP header in '%s'." % (ctl, seqfile))
+         continue
+      f = open(treefile, 'r')
+      trees = [ line for line in f if '(' in line ]
+      f.close()
+      n_taxa = trees and len(_TAXON_RE.findall(trees[0])) or 0
+      if n_seq != n_taxa:
+         errors.append("%s: '%s' has %d sequences but '%s' has %d taxa." % (
+            ctl, seqfile, n_seq, treefile, n_taxa))
+   return jobname, errors
+
 class session:
-   def __init__(self, name):
+   __donestates = ('FINISHED', 'FAILED', 'KILLED', 'DELETED')
+   __specminjobs = 10 # finished jobs needed to predict runtimes
+
+   def __init__(self, name, create=True):
       self.__name = name
       self.__jobfile = name + '.jobs' # default *.jobs
       self.__starttime = time.time()  # float time
@@ -255,7 +522,18 @@ class session:
       #self.__bundlesize = 1 # jobs per call
       #self.__state = None
       self.__joblist = []
-      session._createSessiondir(self) # create session directory
+      self.__specfactor = None        # speculative execution is off
+      self.__specmaxfrac = 0.0        # max. fraction of duplicate jobs
+      self.__speculative = {}         # jobname -> jobid of the duplicate
+      self.__jobrates = []            # observed runtime (sec) per aln_len*n_seq
+      self.__heartbeat = None         # called with the number of done jobs
+      self.__preflightprocs = multiprocessing.cpu_count() # 0 - no preflight
+      self.__rejected = {}            # jobname -> preflight errors
+      self.__cache = None             # resultcache of codeml outputs
+      if create:
+         session._createSessiondir(self) # create session directory
+      elif not os.path.isdir(self.__sessiondir):
+         raise RuntimeError("Session directory '%s' does not exist." % self.__sessiondir)
 
    @staticmethod
    def renewProxy():
@@ -303,6 +581,18 @@ class session:
    def getDbgmode(self):
       return self.__debugmode
 
+   def getSpeculation(self):
+      return (self.__specfactor, self.__specmaxfrac)
+
+   def getRejected(self):
+      return self.__rejected
+
+   def getCache(self):
+      return self.__cache
+
+   def countSpeculative(self):
+      return len(self.__speculative)
+
    def getStarttime(self):
       return time.ctime(self.__starttime)
 
@@ -337,6 +627,33 @@ class session:
    def setEndtime(self, tm):
       self.__endtime = tm
 
+   def setCache(self, cache):
+      """Skip the jobs whose results are in the resultcache."""
+      self.__cache = cache
+
+   def setPreflight(self, nprocs):
+      """Check jobs in nprocs parallel processes before submission (0 - off)."""
+      self.__preflightprocs = int(nprocs)
+
+   def setHeartbeat(self, func):
+      """Call func(n_done) for every submitted job and monitoring round."""
+      self.__heartbeat = func
+
+   def _beat(self, n_done):
+      if self.__heartbeat:
+         self.__heartbeat(n_done)
+
+   def setSpeculation(self, factor=3.0, maxfrac=0.05):
+      """Submit a duplicate of a job to a different cluster if it runs
+      'factor' times longer than predicted from its alignment size;
+      at most 'maxfrac' of the jobs are duplicated. The first copy to
+      finish wins and the other one is killed.
+      """
+      if factor <= 1 or not 0 <= maxfrac <= 1:
+         raise RuntimeError('Incorrect values for speculative execution!')
+      self.__specfactor = float(factor)
+      self.__specmaxfrac = float(maxfrac)
+
    def delJob(self, *jobs):
       for job in jobs:
          self.__joblist.remove(job)
@@ -348,7 +665,11 @@ class session:
        else:
            raise RuntimeError("Session directory '%s' already exists." % dir)
          
-   def submit(self):
+   def submit(self, resume=False):
+      """Submit the jobs of the session. With resume=True the jobs already
+      listed in the jobfile (e.g. by a driver that died) are kept and
+      only the missing ones are submitted.
+      """
       # TODO: 
       #       1. Resubmit failed jobs to different WN.
       #       2. Submit jobs from a slot (a directory with symbolink links to files).
@@ -359,51 +680,244 @@ class session:
       # set "fake" returncode
       rc = 0
 
-      # regexp to mach jobid and cluster name
-      _GSIFTP_RE = re.compile('jobid:\s*(?P<jobid>\S+)', re.I)
-      _CLUSTER_RE = re.compile('gsiftp://(?P<cluster>[^:]+)', re.I)
-
       # write jobID file
       jobfile = session.getJobfile(self)
-      dbg = session.getDbgmode(self)
-      if os.path.exists(jobfile):
+      submitted = {}
+      if resume:
+         submitted = session._readJobfile(self)
+      elif os.path.exists(jobfile):
          os.unlink(jobfile)
 
       # change to session directory (slot)
       session_dir = session.getSessiondir(self)
       #os.chdir(session_dir)
 
-      # build ngsub command-line
-      str = 'ngsub -o %s -d %d' % (jobfile, dbg)
+      # reject invalid jobs before they waste a grid slot
+      rejected = session.preflight(self)
+
       for job in session.getJobs(self):
          # create symlinks to input files in the slot
          #aln_file = job.getInfiles()
-         # append comment line with jobname to jobfile
-         jobname = job.getName()
-         f = open(jobfile, 'a')
-         f.write('# jobname=%s\n' % jobname)
-         f.close()
-
-         # complete ngsub command-line and execute it
-         xrsl_str = job.getXrsl()
-         xrsl_str = xrsl_str.replace('\n', '')
-         ngsub = str + " -e '%s'" % xrsl_str
-         args = shlex.split(ngsub) # tokenize the command-line
-         line = subprocess.Popen(args, stdout=subprocess.PIPE).communicate()[0]
-
-         # parse codeml STDOUT
-         match_jobid = _GSIFTP_RE.search(line)
-         if match_jobid:
-            job.setId(match_jobid.group('jobid'))
-            match_cluster = _CLUSTER_RE.search(job.getId())
-            if match_cluster:
-               job._setCluster(match_cluster.group('cluster'))
+         if job.getName() in submitted:
+            jobid = submitted[job.getName()]
+            job.setId(jobid)
+            job._setCluster(session._getClustername(jobid))
+            job.setState('SUBMITTED')
+            continue
+         if job.getName() in rejected: continue # remain in 'NEW' state
+         if session._lookupCache(self, job): continue
+         session._beat(self, 0)
+         jobid = session._ngsub(self, job)
+         if jobid:
+            job.setId(jobid)
+            job._setCluster(session._getClustername(jobid))
+            job.setTsubmitted(time.time())
             job.setReturncode(rc) # submission succeeded
             job.nextState() # move to next state 'SUBMITTED'
          else:
             rc += 1
             job.setReturncode(rc) # submission failed; remain in 'NEW' state
 
+   def _readJobfile(self):
+      """Return the jobs listed in the jobfile: jobname -> jobID
+      (the first one if the job has speculative copies).
+      """
+      submitted = {}
+      jobfile = session.getJobfile(self)
+      if not os.path.exists(jobfile):
+         return submitted
+
+      jobname = None
+      f = open(jobfile, 'r')
+      for line in f:
+         line = line.strip()
+         if line.startswith('# jobname='):
+            jobname = line[len('# jobname='):]
+         elif line and not line.startswith('#') and jobname:
+            submitted.setdefault(jobname, line)
+            jobname = None
+      f.close()
+      return submitted
+
+   def preflight(self):
+      """Check the control files of all jobs in parallel and return
+      the rejected jobs: jobname -> list of errors.
+      """
+      self.__rejected = {}
+      nprocs = self.__preflightprocs
+      tasks = [ (j.getName(), j.getInputs(), j.getOutputs()) for j in session.getJobs(self) ]
+      if nprocs <= 0 or not tasks:
+         return self.__rejected
+
+      nprocs = min(nprocs, len(tasks)) # no idle processes for a few jobs
+      if nprocs == 1:
+         results = map(_checkJob, tasks)
+      else:
+         pool = multiprocessing.Pool(nprocs)
+         try:
+            results = pool.map(_checkJob, tasks, max(1, len(tasks) // (4 * nprocs)))
+         finally:
+            pool.close()
+            pool.join()
+
+      for jobname, errors in results:
+         if errors:
+            self.__rejected[jobname] = errors
+            for e in errors:
+               print 'Reject job %s: %s' % (jobname, e)
+      return self.__rejected
+
+   def getResultdir(self, job):
+      """Return the directory of the job results: <sessiondir>/<jobname>.
+      Both retrieved and cached results are put there.
+      """
+      return os.path.join(session.getSessiondir(self), job.getName())
+
+   def _lookupCache(self, job):
+      """Copy cached results of the job into its result directory
+      and mark the job as terminated.
+      """
+      cache = self.__cache
+      if not cache or not cache.lookup(job, session.getResultdir(self, job)):
+         return False
+      print 'Job %s: results found in cache' % job.getName()
+      job.setReturncode(0)
+      job.setState('TERMINATED')
+      return True
+
+   def retrieve(self):
+      """Download the outputs of the submitted jobs with ngget into their
+      result directories. Return the number of retrieved jobs.
+      """
+      n = 0
+      sessiondir = session.getSessiondir(self)
+      for job in session.getJobs(self):
+         resultdir = session.getResultdir(self, job)
+         if not job.getId() or os.path.exists(resultdir): continue
+         ngget = 'ngget -d %d -dir %s %s' % (session.getDbgmode(self), sessiondir, job.getId())
+         if subprocess.call(shlex.split(ngget)) != 0: continue
+         # ngget downloads into <dir>/<jobID number>
+         downloaddir = os.path.join(sessiondir, os.path.basename(job.getId().rstrip('/')))
+         if os.path.isdir(downloaddir):
+            os.rename(downloaddir, resultdir)
+            n += 1
+      return n
+
+   def cacheResults(self):
+      """Store the results found in the result directories of the jobs
+      in the resultcache. Return the number of cached jobs.
+      """
+      if not self.__cache: return 0
+      stored = []
+      for job in session.getJobs(self):
+         resultdir = session.getResultdir(self, job)
+         if not os.path.isdir(resultdir): continue
+         entry = self.__cache.store(job, resultdir)
+         if entry: stored.append(entry)
+      removed = set(self.__cache.evict()) # once for all jobs
+      return len([ e for e in stored if e not in removed ])
+
+   @staticmethod
+   def _getClustername(jobid):
+      _CLUSTER_RE = re.compile('gsiftp://(?P<cluster>[^:]+)', re.I)
+      match_cluster = _CLUSTER_RE.search(jobid)
+      if match_cluster:
+         return match_cluster.group('cluster')
+      return None
+
+   def _ngsub(self, job):
+      """Submit the job with ngsub and append it to the jobfile.
+      Return the gsiftp jobID or None if the submission failed.
+      """
+      _GSIFTP_RE = re.compile('jobid:\s*(?P<jobid>\S+)', re.I)
+      jobfile = session.getJobfile(self)
+
+      # append comment line with jobname to jobfile
+      f = open(jobfile, 'a')
+      f.write('# jobname=%s\n' % job.getName())
+      f.close()
+
+      # build ngsub command-line and execute it
+      xrsl_str = job.getXrsl()
+      xrsl_str = xrsl_str.replace('\n', '')
+      ngsub = 'ngsub -o %s -d %d' % (jobfile, session.getDbgmode(self))
+      ngsub += " -e '%s'" % xrsl_str
+      args = shlex.split(ngsub) # tokenize the command-line
+      line = subprocess.Popen(args, stdout=subprocess.PIPE).communicate()[0]
+
+      # parse ngsub STDOUT
+      match_jobid = _GSIFTP_RE.search(line)
+      if match_jobid:
+         return match_jobid.group('jobid')
+      return None
+
+   def _ngkill(self, jobid):
+      args = shlex.split('ngkill -d %d %s' % (session.getDbgmode(self), jobid))
+      return subprocess.call(args)
+
+   def _getMedianrate(self):
+      """Return the median runtime (sec) per alignment cell of the
+      finished jobs or None if too few jobs have finished.
+      """
+      rates = sorted(self.__jobrates)
+      if len(rates) < session.__specminjobs:
+         return None
+      return rates[len(rates) // 2]
+
+   @staticmethod
+   def _predictRuntime(job, rate):
+      """Predict the job runtime (sec) from its alignment size."""
+      return rate * int(job.getAlnlen()) * int(job.getNseq())
+
+   def _speculate(self, jobs):
+      """Resolve and (re-)submit speculative copies of straggler jobs
+      given the ngstat job info: jobid -> [jobname, jobstat, jobrc].
+      """
+      now = time.time()
+      copies = {} # jobname -> [(jobid, jobstat)]
+      for jobid, aref in jobs.iteritems():
+         copies.setdefault(aref[0], []).append((jobid, aref[1]))
+
+      n_max = int(self.__specmaxfrac * session.countJobs(self))
+      rate = session._getMedianrate(self) # once per monitoring round
+      for job in session.getJobs(self):
+         jobname = job.getName()
+         if job.getTcompleted() or jobname not in copies: continue
+         finished = [ jid for jid, st in copies[jobname] if st == 'FINISHED' ]
+         if finished:
+            # the first copy to finish wins; cancel the others
+            winner = finished[0]
+            for jobid, jobstat in copies[jobname]:
+               if jobid != winner and jobstat not in session.__donestates:
+                  print 'Kill speculative copy %s of %s' % (jobid, jobname)
+                  session._ngkill(self, jobid)
+            job.setTcompleted(now)
+            if jobname not in self.__speculative and job.getTsubmitted():
+               cells = int(job.getAlnlen()) * int(job.getNseq())
+               self.__jobrates.append((now - job.getTsubmitted()) / max(cells, 1))
+            job.setId(winner)
+            job._setCluster(session._getClustername(winner))
+            continue
+
+         # straggler detection (SUBMITTED/RUNNING jobs only)
+         if (rate is None
+             or jobname in self.__speculative
+             or not [ st for jid, st in copies[jobname] if st not in session.__donestates ]
+             or len(self.__speculative) >= n_max
+             or job.getCluster() # the job is bound to a cluster
+             or not job.getTsubmitted()):
+            continue
+         predicted = session._predictRuntime(job, rate)
+         if now - job.getTsubmitted() <= self.__specfactor * predicted: continue
+
+         excluded = job.getExcluded()
+         job.setExcluded(excluded + [ c for c in [job._getCluster()] if c ])
+         jobid = session._ngsub(self, job)
+         job.setExcluded(excluded)
+         if jobid:
+            self.__speculative[jobname] = jobid
+            print 'Submit speculative copy %s of %s' % (jobid, jobname)
+
    def monitor(self, timeint=10, *jobnames):
       # TODO:
       #       1. Monitoring based on information in the taskdb rather than ngstat.
@@ -413,7 +927,18 @@ class session:
       _JOBNAME_RE = re.compile('Job\s*Name:\s*(?P<jobname>\S+)', re.I)
       _EXITCODE_RE = re.compile('Exit\s*Code:\s*(?P<exitcode>\d+)', re.I)
 
-      ngstat = 'ngstat -l -i %s -d %d' % (session.getJobfile(self), session.getDbgmode(self))
+      # nothing to monitor if no job has been submitted (e.g. all cached)
+      jobfile = session.getJobfile(self)
+      jobids = []
+      if os.path.exists(jobfile):
+         f = open(jobfile, 'r')
+         jobids = [ l for l in f if l.strip() and not l.startswith('#') ]
+         f.close()
+      if not jobids:
+         session.setEndtime(self, time.time())
+         return
+
+      ngstat = 'ngstat -l -i %s -d %d' % (jobfile, session.getDbgmode(self))
       args = shlex.split(ngstat)
 
       while True:
@@ -448,14 +973,19 @@ class session:
                  jobs[jobid] = [jobname, jobstat, jobrc]
 
          if len(jobs) == 0: all_done = False
+         n_done = 0
+         if self.__specfactor and self.__specmaxfrac > 0:
+            session._speculate(self, jobs)
          for jobid, aref in jobs.iteritems():
             i += 1
             jobname = aref[0]
             jobstat = aref[1]
             jobrc = aref[2]
-            if jobstat not in ('FINISHED', 'FAILED'): all_done = False
+            if jobstat not in session.__donestates: all_done = False
+            else: n_done += 1
             print '%d. %s %s [%s:%d]' % (i, jobname, jobid, jobstat, int(jobrc))
          print
+         session._beat(self, n_done)
          
          if all_done:
             session.setEndtime(self, time.time())
@@ -480,4 +1010,186 @@ class session:
          str = str + `job` + '\n\n'
       return str
 
+class campaign:
+   """A campaign is split into shards, i.e. sessions with their own
+   jobfile and subdirectory. Several driver processes (on one or more hosts)
+   claim the shards through lease records in a shared SQLite database.
+   The lease of a dead driver expires so that another driver takes over
+   its shard. All drivers must add the same jobs to the campaign.
+   """
+   __states = ['NEW', 'SUBMITTED', 'DONE']
+
+   def __init__(self, name, nshards, dbfile=None, leasetime=600):
+      if int(nshards) < 1:
+         raise RuntimeError('Incorrect number of shards!')
+      self.__name = name
+      self.__nshards = int(nshards)
+      self.__dbfile = dbfile or name + '.db' # shared by all drivers
+      self.__leasetime = leasetime         # sec; should exceed the monitoring interval
+      self.__leaserenewed = 0
+      self.__driver = '%s:%d' % (socket.gethostname(), os.getpid())
+      self.__joblist = []
+      if not os.path.isdir(name):
+         try:
+            os.mkdir(name)
+         except OSError: # created by another driver
+            if not os.path.isdir(name): raise
+      campaign._createLeasedb(self)
+
+   #
+   # Accessor methods: "getters"
+   #
+   def getName(self):
+      return self.__name
+
+   def getDriver(self):
+      return self.__driver
+
+   def countShards(self):
+      return self.__nshards
+
+   def countJobs(self):
+      return len(self.__joblist)
+
+   def getShardname(self, idx):
+      return os.path.join(self.__name, 'shard-%03d' % idx)
+
+   def getShardjobs(self, idx):
+      """Return the jobs of the shard; jobs are assigned round-robin
+      by name so that every driver computes the same shards.
+      """
+      _jobs = sorted(self.__joblist, key=lambda j: j.getName())
+      return _jobs[idx::self.__nshards]
+
+   def getProgress(self):
+      """Return the progress aggregated over all shards; the total number
+      of jobs includes the shards that have not been claimed yet.
+      """
+      conn = campaign._connect(self)
+      cur = conn.execute("""
+         SELECT COUNT(*), SUM(state = 'DONE'), SUM(owner IS NOT NULL),
+                SUM(n_done)
+         FROM shard""")
+      row = cur.fetchone()
+      conn.close()
+      return {'n_shards' : row[0], 'n_shards_done' : row[1] or 0,
+              'n_shards_leased' : row[2] or 0, 'n_jobs' : campaign.countJobs(self),
+              'n_jobs_done' : row[3] or 0}
+
+   #
+   # Accessor methods: "setters"
+   #
+   def addJob(self, *jobs):
+      for job in jobs:
+         self.__joblist.append(job)
+
+   def _connect(self):
+      # autocommit mode; transactions are started explicitly
+      return sqlite3.connect(self.__dbfile, timeout=60, isolation_level=None)
+
+   def _createLeasedb(self):
+      conn = campaign._connect(self)
+      conn.execute("""
+         CREATE TABLE IF NOT EXISTS shard(
+            id            INTEGER PRIMARY KEY,
+            state         TEXT,
+            owner         TEXT,
+            lease_expires FLOAT,
+            n_jobs        INTEGER,
+            n_done        INTEGER
+         )""")
+      conn.execute('BEGIN IMMEDIATE')
+      for idx in range(self.__nshards):
+         conn.execute(
+            'INSERT OR IGNORE INTO shard(id, state, n_jobs, n_done) VALUES(?, ?, NULL, 0)',
+            (idx, campaign.__states[0]))
+      conn.execute('COMMIT')
+      conn.close()
+
+   def claimShard(self):
+      """Lease an unfinished shard that is free or whose lease expired.
+      Return (shard index, shard state) or None if there is none left.
+      """
+      now = time.time()
+      conn = campaign._connect(self)
+      conn.execute('BEGIN IMMEDIATE') # lock against other drivers
+      row = conn.execute("""
+         SELECT id, state FROM shard
+         WHERE state != 'DONE' AND (owner IS NULL OR lease_expires < ?)
+         ORDER BY id LIMIT 1""", (now,)).fetchone()
+      if row:
+         conn.execute(
+            'UPDATE shard SET owner = ?, lease_expires = ? WHERE id = ?',
+            (self.__driver, now + self.__leasetime, row[0]))
+      conn.execute('COMMIT')
+      conn.close()
+      self.__leaserenewed = now
+      return row
+
+   def renewLease(self, idx, n_done=None, state=None):
+      """Extend the lease of the shard (at most once per half lease time
+      unless its state changes) and record its progress.
+      """
+      now = time.time()
+      if state is None and now - self.__leaserenewed < self.__leasetime / 2.0:
+         return
+      conn = campaign._connect(self)
+      cur = conn.execute("""
+         UPDATE shard SET lease_expires = ?, n_done = COALESCE(?, n_done),
+                          state = COALESCE(?, state)
+         WHERE id = ? AND owner = ?""",
+         (now + self.__leasetime, n_done, state, idx, self.__driver))
+      conn.close()
+      if cur.rowcount == 0:
+         raise RuntimeError("Lease of shard %d has been taken over." % idx)
+      self.__leaserenewed = now
+
+   def releaseShard(self, idx, state):
+      conn = campaign._connect(self)
+      conn.execute(
+         'UPDATE shard SET owner = NULL, state = ? WHERE id = ? AND owner = ?',
+         (state, idx, self.__driver))
+      conn.close()
+
+   def run(self, timeint=10):
+      """Claim, submit and monitor shards until all of them are done."""
+      while True:
+         claimed = campaign.claimShard(self)
+         if claimed is None:
+            p = campaign.getProgress(self)
+            if p['n_shards_done'] == p['n_shards']:
+               break # all shards are done
+            # wait for the leases of other (possibly dead) drivers to expire
+            time.sleep(self.__leasetime / 2.0)
+            continue
+         idx, state = claimed
+         name = campaign.getShardname(self, idx)
+         jobs = campaign.getShardjobs(self, idx)
+
+         # take over the session of a dead driver if there is one
+         s = session(name, create=not os.path.isdir(name))
+         s.addJob(*jobs)
+         s.setHeartbeat(lambda n_done: campaign.renewLease(self, idx, n_done))
+         conn = campaign._connect(self)
+         conn.execute('UPDATE shard SET n_jobs = ? WHERE id = ?', (len(jobs), idx))
+         conn.close()
+         try:
+            if state == 'NEW':
+               # keep the jobs submitted by a dead driver, if any
+               s.submit(resume=True)
+               campaign.renewLease(self, idx, 0, 'SUBMITTED')
+            s.monitor(timeint)
+         except RuntimeError, e: # lease lost, e.g. the driver was stalled
+            print 'Driver %s: %s' % (self.__driver, e)
+            continue
+         campaign.renewLease(self, idx, len(jobs), 'DONE')
+         campaign.releaseShard(self, idx, 'DONE')
+         campaign.printProgress(self)
+
+   def printProgress(self):
+      p = campaign.getProgress(self)
+      print 'Campaign %s: %d/%d shards done (%d leased), %d/%d jobs done' % (
+         self.__name, p['n_shards_done'], p['n_shards'], p['n_shards_leased'],
+         p['n_jobs_done'], p['n_jobs'])
+
 # create a taskdb, populate session table, register all jobs, process jobs, remove (or tag as DONE) successfully completed jobs
@@ -18,6 +18,7 @@ import gc3libs.persistence
 from optparse import OptionParser
 import sqlite3
 import re
+import time
 
 def main():
    parser = OptionParser()
@@ -53,6 +54,14 @@ def main():
       default = False,
       help = "read an existing database (use the '-d' option) and print the job information onto screen")
 
+   parser.add_option(
+      "-t",
+      "--timeline",
+      action = "store",
+      dest = "timeline_path",
+      default = None,
+      help = "export the per-minute concurrency timeline (jobs running/queued/completed, effective cores) into a tab-separated file")
+
    (opt, args) = parser.parse_args()
    sql_create_table = """
    CREATE TABLE IF NOT EXISTS job(
@@ -75,6 +84,22 @@ def main():
    );
    """
 
+   sql_create_table_telemetry = """
+   CREATE TABLE IF NOT EXISTS job_telemetry(
+      job_id             TEXT [jobID; references job(id)],
+      ctl                TEXT [codeml control file; ctl field],
+      host               TEXT [hostname of the worker node; host field],
+      cpu                TEXT [CPU model of the worker node; cpu field],
+      start_time         TEXT [start datetime of the codeml run; start_time field],
+      end_time           TEXT [end datetime of the codeml run; end_time field],
+      wall_time          FLOAT [wall-clock time of the codeml run (sec); wall_time field],
+      user_time          FLOAT [user CPU time of the codeml run (sec); user_time field],
+      sys_time           FLOAT [system CPU time of the codeml run (sec); sys_time field],
+      max_rss_kb         INTEGER [peak resident memory of the codeml run (kB); max_rss_kb field],
+      exit_code          INTEGER [codeml_worker.pl exit code; exit_code field]
+   );
+   """
+
    sql_create_view_timevar = """
    CREATE VIEW v_jobs_timevar AS
    SELECT
@@ -113,7 +138,23 @@ def main():
    GROUP BY cluster ORDER BY n_jobs DESC;
    """
 
+   sql_create_view_usage = """
+   CREATE VIEW v_worker_usage AS
+   SELECT
+      COUNT(*) n_runs,
+      j.cluster || ':' || t.host || ':' || t.cpu wn,
+      ROUND(AVG(t.wall_time)) avg_wall_time,
+      ROUND(AVG(t.user_time+t.sys_time)) avg_cpu_time,
+      ROUND(AVG((t.user_time+t.sys_time)/t.wall_time), 2) avg_cpu_util,
+      MAX(t.max_rss_kb) max_rss_kb,
+      ROUND(AVG(t.max_rss_kb)) avg_rss_kb,
+      SUM(t.exit_code != 0) n_failed
+   FROM job j JOIN job_telemetry t ON t.job_id = j.id
+   GROUP BY wn ORDER BY avg_cpu_util;
+   """ # low CPU utilization points to overloaded nodes
+
    sql_delete_rows = "DELETE FROM job;"
+   sql_delete_telemetry_rows = "DELETE FROM job_telemetry;"
 
    sql_insert_row = """
    INSERT INTO job(
@@ -135,6 +176,26 @@ def main():
    ) VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s);
    """
 
+   sql_insert_telemetry_row = """
+   INSERT INTO job_telemetry(
+      job_id,
+      ctl,
+      host,
+      cpu,
+      start_time,
+      end_time,
+      wall_time,
+      user_time,
+      sys_time,
+      max_rss_kb,
+      exit_code
+   ) VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s);
+   """
+
+   telemetry_fields = ('ctl', 'host', 'cpu', 'start_time', 'end_time', 'wall_time',
+                       'user_time', 'sys_time', 'max_rss_kb', 'exit_code')
+   telemetry_file_sfx = '.telemetry.tsv' # written by codeml_worker.pl
+
    sql_jobs_per_cluster = """
    SELECT
       cluster,
@@ -160,17 +221,55 @@ def main():
 
    sql_select_view_timevar = "" # NOT IMPLEMENTED
 
+   sql_select_job_times = """
+   SELECT
+      time_submitted,
+      time_terminated,
+      COALESCE(codeml_walltime_h0, 0) + COALESCE(codeml_walltime_h1, 0)
+   FROM job
+   WHERE time_submitted IS NOT NULL AND time_terminated IS NOT NULL;
+   """
+
+   def read_telemetry(job_id, download_dir):
+      """
+      Return the records of the codeml_worker.pl telemetry files
+      found in the job's download directory.
+      """
+      rows = []
+      if not download_dir or not os.path.isdir(download_dir):
+         return rows
+
+      for fname in sorted(os.listdir(download_dir)):
+         if not fname.endswith(telemetry_file_sfx): continue
+         f = open(join(download_dir, fname), 'r')
+         lines = f.read().splitlines()
+         f.close()
+         if len(lines) < 2: continue # no record
+         header = lines[0].split('\t')
+         for line in lines[1:]:
+            rec = dict(zip(header, line.split('\t')))
+            row = [job_id]
+            for field in telemetry_fields:
+               val = rec.get(field, 'NA')
+               row.append(None if val == 'NA' else val)
+            rows.append(row)
+      return rows
+
    def create_taskdb():
       """
-      Populate a new 'job' table, 'v_job' view
+      Populate a new 'job' and 'job_telemetry' tables, views
       and delete rows from previous runs.
       """
       cur = conn.cursor()
       cur.execute(sql_create_table)
+      cur.execute(sql_create_table_telemetry)
       cur.execute(sql_create_view_session)
       cur.execute(sql_create_view_timevar)
       cur.execute(sql_create_view_failed_jobs) 
+      cur.execute(sql_create_view_usage)
       cur.execute(sql_delete_rows) 
+      cur.execute(sql_delete_telemetry_rows)
+      telemetry_rows = []
       mystore=gc3libs.persistence.FilesystemStore(opt.session_path)
       for jobid in mystore.list():
          try:
@@ -194,9 +293,14 @@ def main():
                   getattr(job, 'aln_info', None)[0]['aln_len'],
                   getattr(job, 'aln_info', None)[0]['n_seq']
                )
+               telemetry_rows.extend(read_telemetry(
+                  job.persistent_id,
+                  getattr(job.execution, 'download_dir', None)))
          except:
             pass
 
+      # bulk-load the per-run resource usage
+      cur.executemany(sql_insert_telemetry_row, telemetry_rows)
       conn.commit()
 
    def nvl(val1, val2):
@@ -268,6 +372,82 @@ def main():
       for r in rows:
          print "%s|%s|%d" % (r[0], r[1], r[2])
 
+   def sweep_timeline(rows, binsize=60):
+      """
+      Return the per-bin series (bin, bin start time, jobs running, jobs
+      queued, jobs completed, effective cores) from (time_submitted, time_terminated,
+      codeml walltime) rows in one pass over the sorted events. A job is
+      queued from its submission until codeml starts, i.e. until its
+      termination minus the codeml walltime, and running afterwards.
+      Running/queued jobs are counted at the end of each bin, completed
+      jobs within the bin and effective cores are averaged over the bin.
+      """
+      QUEUED, RUNNING, COMPLETED = 0, 1, 2
+      events = []
+      for t_sub, t_term, walltime in rows:
+         t_run = min(max(t_sub, t_term - walltime), t_term)
+         events.extend([(t_sub, QUEUED), (t_run, RUNNING), (t_term, COMPLETED)])
+      if not events:
+         return []
+      events.sort()
+
+      series = []
+      running = queued = completed = 0
+      busy = 0.0 # core-seconds in the current bin
+      t_prev = events[0][0]
+      bin_end = t_prev + binsize
+      for t, kind in events:
+         while t >= bin_end: # close the bins passed by this event
+            busy += running * (bin_end - t_prev)
+            series.append((len(series), bin_end - binsize, running, queued, completed, busy / binsize))
+            completed = 0
+            busy = 0.0
+            t_prev = bin_end
+            bin_end += binsize
+         busy += running * (t - t_prev)
+         t_prev = t
+         if kind == QUEUED:
+            queued += 1
+         elif kind == RUNNING:
+            queued -= 1
+            running += 1
+         else:
+            running -= 1
+            completed += 1
+      series.append((len(series), bin_end - binsize, running, queued, completed, busy / binsize)) # last bin
+      return series
+
+   def export_timeline(path):
+      """
+      Write the per-minute concurrency timeline into a tab-separated file
+      and print its summary.
+      """
+      cur = conn.cursor()
+      cur.execute(sql_select_job_times)
+      series = sweep_timeline(cur.fetchall())
+
+      f = open(path, 'w')
+      f.write('minute\ttime\trunning\tqueued\tcompleted\tcores\n')
+      for r in series:
+         f.write('%d\t%.0f\t%d\t%d\t%d\t%.2f\n' % r) # time: bin start (epoch)
+      f.close()
+
+      if series:
+         avg_cores = sum(r[5] for r in series) / len(series)
+         print """
+# Timeline exported to: %s (%d min)
+# Timeline start datetime: %s (%.0f)
+# Peak number of running jobs: %d
+# Peak number of queued jobs: %d
+# Average effective cores in use: %.2f
+   """ % (path,
+          len(series),
+          time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(series[0][1])),
+          series[0][1],
+          max(r[2] for r in series),
+          max(r[3] for r in series),
+          avg_cores)
+
 ### Main ###
 
    if opt.read_db is True and opt.db_path is ':memory:':
@@ -283,6 +463,8 @@ def main():
    if opt.read_db is False:
       create_taskdb()
    print_jobinfo()
+   if opt.timeline_path:
+      export_timeline(opt.timeline_path)
    conn.close()
 if __name__ == '__main__' : main()
 
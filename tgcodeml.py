@@ -18,9 +18,12 @@ def main():
    h1_sfx = '.H1'
    tree_sfx = '.nwk'
    aln_sfx = '.phy'
+   tel_sfx = '.telemetry.tsv'
    #data_dir  = '' # not supported yet
 
    s = gcodeml.session('test-session') # create gcodeml session object
+   # Sharded mode: run this script in several driver processes with
+   #s = gcodeml.campaign('test-campaign', 4) # and s.run() instead of submit/monitor
    for i in range(1, 4):
       # set gcodeml args, input and outputs
       jobnm = data_pfx + str(i)
@@ -31,17 +34,23 @@ def main():
       aln = basenm + aln_sfx
       mlc_h0 = basenm + h0_sfx + mlc_sfx
       mlc_h1 = basenm + h1_sfx + mlc_sfx
+      tel_h0 = basenm + h0_sfx + tel_sfx
+      tel_h1 = basenm + h1_sfx + tel_sfx
       args = [ctl_h0, ctl_h1]
       inputs = [ctl_h0, ctl_h1, tree, aln]
-      outputs = [mlc_h0, mlc_h1]
+      outputs = [mlc_h0, mlc_h1, tel_h0, tel_h1]
 
       j = gcodeml.job(jobnm, args, inputs, outputs) # create gcodeml job
+      j.setWarmstart()                  # warm-start H1 from H0 estimates
       #j.setWalltime("2 minutes")        # set walltime limit (optional)
       #j.setCluster("ce.lhep.unibe.ch")  # set target cluster(s) (optional)
       print j
       s.addJob(j) # add job to session
+   #s.setSpeculation(3, 0.05) # duplicate straggler jobs (optional)
+   #s.setCache(gcodeml.resultcache('codeml-cache')) # skip cached jobs (optional)
    s.submit()    # submit session
    s.monitor()   # monitor session
+   #s.retrieve(); s.cacheResults() # download results into <session>/<job> and cache them
 
    print 'Session started:', s.getStarttime()
    print 'Session ended:', s.getEndtime()